@@ -3,6 +3,19 @@
 This module defines a custom graph.
 """
 
-from agent.graph import graph
+from typing import Any
 
-__all__ = ["graph"]
+from agent.graph import get_graph
+
+# Importing the submodule bound ``agent.graph`` to the module object; drop
+# that binding so ``graph`` resolves to the compiled graph, built on demand.
+globals().pop("graph", None)
+
+__all__ = ["get_graph", "graph"]
+
+
+def __getattr__(name: str) -> Any:
+    """Resolve ``graph`` lazily for ``from agent import graph``."""
+    if name == "graph":
+        return get_graph()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
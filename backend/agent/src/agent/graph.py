@@ -2,12 +2,19 @@
 
 A simple conversational agent that works with the LangGraph frontend.
 """
-from typing import Annotated, Sequence, TypedDict
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+import atexit
+import functools
+import math
+from typing import Annotated, Any, Optional, Sequence, TypedDict
+
+import httpx
+from langchain_core.messages import BaseMessage, SystemMessage, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableConfig
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode
+from langgraph.graph.state import CompiledStateGraph
 
 # System prompt for the agent
 SYSTEM_PROMPT = """You are a helpful and resourceful AI assistant.
@@ -22,6 +29,13 @@ You can help with a wide variety of tasks including:
 
 Be concise, accurate, and helpful in your responses."""
 
+# Built once; the prompt is static, so every turn can share this message
+SYSTEM_MESSAGE = SystemMessage(content=SYSTEM_PROMPT)
+
+# Upper bound on the prompt tokens re-sent to the model on each turn. Tokens
+# are estimated, not exact, so this sits far below gpt-4o's 128k window.
+MAX_HISTORY_TOKENS = 6_000
+
 
 # Define the state for the agent
 class AgentState(TypedDict):
@@ -29,21 +43,90 @@ class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
 
 
-# Initialize the LLM
-model = ChatOpenAI(model="gpt-4o", temperature=0.7, streaming=True)
+# Connection pool limits for the OpenAI HTTP clients
+OPENAI_HTTP_LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=100,
+    keepalive_expiry=60.0,
+)
+
+
+# Initialize the LLM on first use so importing this module does not
+# require OPENAI_API_KEY or pay for client construction.
+@functools.cache
+def get_model() -> ChatOpenAI:
+    """Return the shared chat model, creating it on first use."""
+    http_client = httpx.Client(
+        http2=True,
+        limits=OPENAI_HTTP_LIMITS,
+        timeout=60.0,
+    )
+    atexit.register(http_client.close)
+    http_async_client = httpx.AsyncClient(
+        http2=True,
+        limits=OPENAI_HTTP_LIMITS,
+        timeout=60.0,
+    )
+    return ChatOpenAI(
+        model="gpt-4o",
+        temperature=0.7,
+        streaming=True,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+
+
+def count_history_tokens(messages: Sequence[BaseMessage]) -> int:
+    """Estimate the prompt tokens for messages, erring high on non-ASCII text.
+
+    count_tokens_approximately assumes four characters per token, which
+    undercounts CJK and other non-Latin scripts several-fold, so each
+    non-ASCII character is charged as a whole token instead.
+    """
+    non_ascii = 0
+    for message in messages:
+        text = str(message.content)
+        non_ascii += len(text) - len(text.encode("ascii", "ignore"))
+    return count_tokens_approximately(messages) + math.ceil(non_ascii * 0.75)
+
+
+def trim_history(messages: Sequence[BaseMessage]) -> list[BaseMessage]:
+    """Fit a system-prefixed conversation into MAX_HISTORY_TOKENS.
+
+    The system message and the latest message are always kept; only the
+    prior history is trimmed, oldest turns first.
+    """
+    system, *history = messages
+    if not history:
+        return [system]
+    *prior, latest = history
+    
+    # Whatever the system prompt and current message leave over goes to history
+    budget = MAX_HISTORY_TOKENS - count_history_tokens([system, latest])
+    prior = trim_messages(
+        prior,
+        max_tokens=max(budget, 0),
+        token_counter=count_history_tokens,
+        strategy="last",
+        start_on="human",
+    )
+    return [system, *prior, latest]
 
 
 # Define the agent node
-def call_model(state: AgentState) -> dict:
+async def call_model(state: AgentState) -> dict:
     """Call the language model with the current state."""
     messages = state["messages"]
     
     # Prepend system message if not already present
     if not messages or not isinstance(messages[0], SystemMessage):
-        messages = [SystemMessage(content=SYSTEM_PROMPT)] + list(messages)
+        messages = (SYSTEM_MESSAGE, *messages)
+    
+    # Drop the oldest turns once the history exceeds the token budget
+    messages = trim_history(messages)
     
     # Call the model
-    response = model.invoke(messages)
+    response = await get_model().ainvoke(messages)
     
     # Return the response to be added to state
     return {"messages": [response]}
@@ -65,5 +148,23 @@ def create_agent_graph():
     return workflow.compile()
 
 
+@functools.cache
+def _build_graph() -> CompiledStateGraph:
+    """Compile the agent graph exactly once."""
+    return create_agent_graph()
+
+
 # Export the compiled graph
-graph = create_agent_graph()
\ No newline at end of file
+def get_graph(config: Optional[RunnableConfig] = None) -> CompiledStateGraph:
+    """Return the compiled agent graph, building it on first use.
+
+    Also used as the LangGraph server graph factory, which passes ``config``.
+    """
+    return _build_graph()
+
+
+def __getattr__(name: str) -> Any:
+    """Resolve ``graph`` lazily for ``from agent.graph import graph``."""
+    if name == "graph":
+        return get_graph()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,54 @@
+from langchain_core.messages import AIMessage, HumanMessage
+
+from agent.graph import (
+    MAX_HISTORY_TOKENS,
+    SYSTEM_MESSAGE,
+    count_history_tokens,
+    trim_history,
+)
+
+
+def test_trim_history_keeps_oversized_latest_message() -> None:
+    latest = HumanMessage(content="x" * (MAX_HISTORY_TOKENS * 8))
+    history = [
+        SYSTEM_MESSAGE,
+        HumanMessage(content="hello"),
+        AIMessage(content="hi"),
+        latest,
+    ]
+
+    assert trim_history(history) == [SYSTEM_MESSAGE, latest]
+
+
+def test_trim_history_drops_oldest_turns_over_budget() -> None:
+    turn = "y" * (MAX_HISTORY_TOKENS * 2)
+    old = [HumanMessage(content=turn), AIMessage(content=turn)]
+    recent = [HumanMessage(content="recent"), AIMessage(content="reply")]
+    latest = HumanMessage(content="question")
+
+    trimmed = trim_history([SYSTEM_MESSAGE, *old, *recent, latest])
+
+    assert trimmed == [SYSTEM_MESSAGE, *recent, latest]
+    assert count_history_tokens(trimmed) <= MAX_HISTORY_TOKENS
+
+
+def test_trim_history_leaves_short_conversations_untouched() -> None:
+    history = [SYSTEM_MESSAGE, HumanMessage(content="hello")]
+
+    assert trim_history(history) == history
+
+
+def test_trim_history_counts_non_ascii_text_conservatively() -> None:
+    # CJK text runs near one token per character, 4x the chars/4 estimate
+    turn = "日本語のテキスト" * (MAX_HISTORY_TOKENS // 32)
+    history = [SYSTEM_MESSAGE]
+    for _ in range(8):
+        history += [HumanMessage(content=turn), AIMessage(content=turn)]
+    latest = HumanMessage(content="question")
+
+    trimmed = trim_history([*history, latest])
+
+    assert trimmed[-1] is latest
+    assert len(trimmed) < len(history) + 1
+    chars = sum(len(str(message.content)) for message in trimmed)
+    assert chars <= MAX_HISTORY_TOKENS
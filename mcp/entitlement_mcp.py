@@ -4,15 +4,36 @@ This MCP server provides tools for checking user entitlements
 via the profile API.
 """
 import asyncio
+import functools
 import logging
-import urllib.parse
-from typing import Any, Dict, Optional
+import os
+import re
+import ssl
+import sys
+import time
+from collections import OrderedDict
+from io import TextIOWrapper
+from typing import Any, Dict, Optional, Union
 
+import anyio
+import certifi
 import httpx
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
 from mcp.types import Tool, TextContent
 
+# Prefer orjson for JSON; stdlib json also accepts bytes when parsing
+try:
+    from orjson import dumps as _orjson_dumps
+    from orjson import loads as json_loads
+
+    def json_dumps(obj: Any) -> str:
+        """Serialize obj to a JSON string."""
+        return _orjson_dumps(obj).decode("utf-8")
+except ImportError:
+    from json import dumps as json_dumps
+    from json import loads as json_loads
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,121 +41,446 @@ logger = logging.getLogger(__name__)
 # Profile API configuration
 PROFILE_API_URL = "https://localhost:8080/services/security/profile"
 
+# TLS verification for the profile API; PROFILE_SSL_VERIFY=0 disables it (dev only)
+PROFILE_SSL_VERIFY = os.environ.get("PROFILE_SSL_VERIFY", "1") != "0"
+PROFILE_CA_BUNDLE = os.environ.get("PROFILE_CA_BUNDLE")
+
+
+def _build_ssl_context() -> Union[ssl.SSLContext, bool]:
+    """Build the profile API TLS context once, or False when verification is off."""
+    if not PROFILE_SSL_VERIFY:
+        return False
+    return ssl.create_default_context(cafile=PROFILE_CA_BUNDLE or certifi.where())
+
+
+# Shared HTTP client so successive lookups reuse pooled keep-alive connections
+_client = httpx.AsyncClient(
+    verify=_build_ssl_context(),
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=30.0,
+    ),
+    timeout=httpx.Timeout(10.0, connect=5.0),
+    headers={"Content-Type": "application/x-www-form-urlencoded"},
+)
+
+# Profile API request template; only the form body varies per call
+_build_profile_request = functools.partial(
+    _client.build_request, "POST", PROFILE_API_URL
+)
+
+# Form body prefix for the profile API request
+_UUNAME_PREFIX = b"uuname="
+
+# Accepted usernames; every allowed character is form-encoding safe
+_USERNAME_RE = re.compile(r"\A[A-Za-z0-9_.\-]{1,64}\Z")
+
+# Most usernames one check_user_entitlements call may look up, kept well
+# under the client's max_connections so one batch cannot exhaust the pool
+MAX_BATCH_SIZE = 50
+
+# Read buffer size for the JSON-RPC stdin stream
+STDIO_BUFFER_SIZE = 65536
+
+# Profile fields reported in debug logs, in data.profile of the API response
+_PROFILE_FIELDS = (
+    "username",
+    "email",
+    "employeeId",
+    "firstName",
+    "lastName",
+    "role",
+    "status",
+)
+_PROFILE_LOG_FORMAT = " ".join(f"{field}=%s" for field in _PROFILE_FIELDS)
+
+# Profile cache configuration (seconds a profile stays fresh, max entries)
+PROFILE_CACHE_TTL = float(os.environ.get("ENTITLEMENT_CACHE_TTL", "30"))
+PROFILE_CACHE_SIZE = 1024
+
+# Serve the last good profile when the profile API fails (off by default)
+STALE_FALLBACK_ENABLED = os.environ.get("ENTITLEMENT_STALE_FALLBACK") == "1"
+STALE_FALLBACK_TTL = 3600.0
+
+# username -> (expiry on the monotonic clock, profile API response body)
+_profile_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+# username -> (time stored on the monotonic clock, last good response body)
+_stale_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+# username -> in-flight lookup shared by concurrent callers
+_inflight: Dict[str, "asyncio.Task[str]"] = {}
+
+# Optional Redis cache shared by every server process on the host
+REDIS_URL = os.environ.get("REDIS_URL")
+_REDIS_KEY_PREFIX = "entitlement:v1:"
+
+# Seconds to wait on Redis before falling back to the profile API
+REDIS_TIMEOUT = 0.5
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+_redis = None
+if REDIS_URL:
+    if aioredis is None:
+        logger.warning("redis_unavailable reason=package_not_installed")
+    else:
+        _redis = aioredis.from_url(
+            REDIS_URL,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT,
+        )
+
+# Pending fire-and-forget Redis writes, referenced so they are not collected
+_redis_writes: "set[asyncio.Task[None]]" = set()
+
 # Initialize MCP server
 app = Server("entitlement-server")
 
 
+def _cache_get(username: str) -> Optional[str]:
+    """Return the cached profile body for a username if still fresh."""
+    entry = _profile_cache.get(username)
+    if entry is None:
+        return None
+    expires_at, body = entry
+    if expires_at <= time.monotonic():
+        del _profile_cache[username]
+        return None
+    _profile_cache.move_to_end(username)
+    return body
+
+
+def _cache_set(username: str, body: str, ttl: float = PROFILE_CACHE_TTL) -> None:
+    """Cache a profile body for ttl seconds, evicting the least recently used entry."""
+    now = time.monotonic()
+    _profile_cache[username] = (now + ttl, body)
+    _profile_cache.move_to_end(username)
+    if len(_profile_cache) > PROFILE_CACHE_SIZE:
+        _profile_cache.popitem(last=False)
+    
+    if STALE_FALLBACK_ENABLED:
+        _stale_cache[username] = (now, body)
+        _stale_cache.move_to_end(username)
+        if len(_stale_cache) > PROFILE_CACHE_SIZE:
+            _stale_cache.popitem(last=False)
+
+
+def _stale_get(username: str) -> Optional[str]:
+    """Return the last good profile body for a username, if recent enough."""
+    if not STALE_FALLBACK_ENABLED:
+        return None
+    entry = _stale_cache.get(username)
+    if entry is None or time.monotonic() - entry[0] > STALE_FALLBACK_TTL:
+        return None
+    return entry[1]
+
+
+async def _fetch_profile(username: str) -> str:
+    """Call the profile API and cache the response body."""
+    # Usernames are validated by _lookup, so they need no urlencoding
+    body = _UUNAME_PREFIX + username.encode("ascii")
+    
+    logger.debug("profile_api request url=%s body=%r", PROFILE_API_URL, body)
+    
+    # Call the profile API over the shared client
+    response = await _client.send(_build_profile_request(content=body))
+    
+    response.raise_for_status()
+    raw = response.content
+    
+    logger.info("profile_api response u=%s status=%s", username, response.status_code)
+    
+    # The body is cached and spliced into batch replies untouched, so always
+    # parse it to reject invalid JSON; only the field extraction is debug-only
+    profile_data = json_loads(raw)
+    if logger.isEnabledFor(logging.DEBUG):
+        try:
+            profile = profile_data["data"]["profile"]
+        except (KeyError, TypeError):
+            profile = None
+        if not isinstance(profile, dict):
+            profile = {}
+        logger.debug(
+            "profile_data " + _PROFILE_LOG_FORMAT,
+            *map(profile.get, _PROFILE_FIELDS),
+        )
+    
+    # The body is JSON (UTF-8), so decode it once for both cache and reply
+    profile_text = raw.decode("utf-8")
+    _cache_set(username, profile_text)
+    return profile_text
+
+
+async def _redis_get(username: str) -> Optional[tuple[str, float]]:
+    """Return a profile body and its remaining seconds from Redis, if configured."""
+    if _redis is None:
+        return None
+    key = _REDIS_KEY_PREFIX + username
+    try:
+        async with _redis.pipeline(transaction=False) as pipe:
+            value, pttl = await pipe.get(key).pttl(key).execute()
+    except Exception as e:
+        logger.warning("redis_error op=get u=%s err=%s", username, e)
+        return None
+    # PTTL is -2 once the key has expired between the two commands
+    if value is None or pttl == -2:
+        return None
+    ttl = PROFILE_CACHE_TTL if pttl < 0 else pttl / 1000
+    return value.decode("utf-8"), ttl
+
+
+async def _redis_set(username: str, body: str) -> None:
+    """Store a profile body in the shared Redis cache, if configured."""
+    # Redis rejects a non-positive expiry, and such a body would be stale anyway
+    px = int(PROFILE_CACHE_TTL * 1000)
+    if _redis is None or px <= 0:
+        return
+    try:
+        await _redis.set(_REDIS_KEY_PREFIX + username, body, px=px)
+    except Exception as e:
+        logger.warning("redis_error op=set u=%s err=%s", username, e)
+
+
+def _redis_set_later(username: str, body: str) -> None:
+    """Store a profile body in Redis without making the caller wait."""
+    if _redis is None:
+        return
+    task = asyncio.ensure_future(_redis_set(username, body))
+    _redis_writes.add(task)
+    task.add_done_callback(_redis_writes.discard)
+
+
+async def _load_profile(username: str) -> str:
+    """Load a profile body from Redis, falling back to the profile API."""
+    shared = await _redis_get(username)
+    if shared is not None:
+        logger.info("redis_hit u=%s", username)
+        # Expire locally when the shared entry does, not a full TTL later
+        profile_text, ttl = shared
+        _cache_set(username, profile_text, ttl)
+        return profile_text
+    
+    profile_text = await _fetch_profile(username)
+    _redis_set_later(username, profile_text)
+    return profile_text
+
+
+async def _get_profile(username: str) -> str:
+    """Return a profile body from cache, or fetch it once for all waiters."""
+    cached = _cache_get(username)
+    if cached is not None:
+        logger.info("cache_hit u=%s", username)
+        return cached
+    
+    task = _inflight.get(username)
+    if task is None:
+        task = asyncio.ensure_future(_load_profile(username))
+        _inflight[username] = task
+        task.add_done_callback(lambda _: _inflight.pop(username, None))
+    
+    # Shield so one cancelled caller does not abort the shared request
+    return await asyncio.shield(task)
+
+
+# Tool list and constant responses never change, so build them once
+_TOOLS = [
+    Tool(
+        name="check_user_entitlement",
+        description="Check user entitlement and profile from the security API",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "username": {
+                    "type": "string",
+                    "description": "Username to check (e.g., pe06003)",
+                }
+            },
+            "required": ["username"],
+        },
+    ),
+    Tool(
+        name="check_user_entitlements",
+        description="Check entitlements and profiles for several users at once",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "usernames": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "maxItems": MAX_BATCH_SIZE,
+                    "description": "Usernames to check (e.g., [\"pe06003\"])",
+                }
+            },
+            "required": ["usernames"],
+        },
+    ),
+]
+
+
+def _error_text(message: str) -> str:
+    """Return a JSON error body with the message properly escaped."""
+    return json_dumps({"error": message})
+
+
+def _err(message: str) -> list[TextContent]:
+    """Return a tool result carrying a JSON error body."""
+    return [
+        TextContent(
+            type="text",
+            text=_error_text(message),
+        )
+    ]
+
+
+_ERR_NO_USERNAME = _err("Username is required")
+
+_ERR_NO_USERNAMES = _err("Usernames are required")
+
+_ERR_INVALID_USERNAMES = _err("Usernames must be strings")
+
+_ERR_TOO_MANY_USERNAMES = _err(f"At most {MAX_BATCH_SIZE} usernames per call")
+
+_ERR_INVALID_USERNAME_TEXT = _error_text("Invalid username")
+
+
 @app.list_tools()
 async def list_tools() -> list[Tool]:
     """List available tools."""
+    return _TOOLS
+
+
+async def _lookup(username: str) -> str:
+    """Return the profile body for a username, or a JSON error body."""
+    # Reject malformed usernames before any network I/O
+    if not isinstance(username, str) or not _USERNAME_RE.match(username):
+        logger.error("invalid_username u=%r", username)
+        return _ERR_INVALID_USERNAME_TEXT
+    
+    try:
+        return await _get_profile(username)
+        
+    except httpx.HTTPError as e:
+        logger.error("profile_api http_error u=%s err=%s", username, e)
+        stale = _stale_get(username)
+        if stale is not None:
+            logger.warning("serving_stale_profile u=%s", username)
+            return stale
+        return _error_text(f"HTTP error: {e}")
+    except Exception as e:
+        logger.error("unexpected_error u=%s err=%s", username, e)
+        return _error_text(f"Unexpected error: {e}")
+
+
+async def _check_user_entitlement(arguments: Any) -> list[TextContent]:
+    """Handle check_user_entitlement for a single username."""
+    username = arguments.get("username")
+    
+    if not username:
+        logger.error("check_entitlement missing_username")
+        return _ERR_NO_USERNAME
+    
+    logger.info("check_entitlement u=%r", username)
+    
     return [
-        Tool(
-            name="check_user_entitlement",
-            description="Check user entitlement and profile from the security API",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "username": {
-                        "type": "string",
-                        "description": "Username to check (e.g., pe06003)",
-                    }
-                },
-                "required": ["username"],
-            },
+        TextContent(
+            type="text",
+            text=await _lookup(username),
         )
     ]
 
 
-@app.call_tool()
-async def call_tool(name: str, arguments: Any) -> list[TextContent]:
-    """Handle tool calls."""
+async def _check_user_entitlements(arguments: Any) -> list[TextContent]:
+    """Handle check_user_entitlements, looking users up concurrently."""
+    usernames = arguments.get("usernames")
     
-    if name == "check_user_entitlement":
-        username = arguments.get("username")
-        
-        if not username:
-            logger.error("❌ BACKEND MCP: No username provided")
-            return [
-                TextContent(
-                    type="text",
-                    text='{"error": "Username is required"}',
-                )
-            ]
-        
-        logger.info(f"🔍 BACKEND MCP: Checking entitlement for username: {username}")
-        
-        try:
-            # Call the profile API
-            async with httpx.AsyncClient(verify=False) as client:
-                # Prepare form data
-                data = {"uuname": username}
-                
-                logger.info(f"📤 BACKEND MCP: Calling profile API: {PROFILE_API_URL}")
-                logger.info(f"📤 BACKEND MCP: Request data: {data}")
-                
-                response = await client.post(
-                    PROFILE_API_URL,
-                    data=data,
-                    headers={"Content-Type": "application/x-www-form-urlencoded"},
-                    timeout=10.0,
-                )
-                
-                response.raise_for_status()
-                profile_data = response.json()
-                
-                logger.info(f"✅ BACKEND MCP: Profile API Response Status: {response.status_code}")
-                logger.info(f"✅ BACKEND MCP: Profile Data Received:")
-                logger.info(f"   - Username: {profile_data.get('data', {}).get('profile', {}).get('username')}")
-                logger.info(f"   - Email: {profile_data.get('data', {}).get('profile', {}).get('email')}")
-                logger.info(f"   - Employee ID: {profile_data.get('data', {}).get('profile', {}).get('employeeId')}")
-                logger.info(f"   - Name: {profile_data.get('data', {}).get('profile', {}).get('firstName')} {profile_data.get('data', {}).get('profile', {}).get('lastName')}")
-                logger.info(f"   - Roles: {profile_data.get('data', {}).get('profile', {}).get('role')}")
-                logger.info(f"   - Status: {profile_data.get('data', {}).get('profile', {}).get('status')}")
-                
-                return [
-                    TextContent(
-                        type="text",
-                        text=response.text,
-                    )
-                ]
-                
-        except httpx.HTTPError as e:
-            logger.error(f"❌ BACKEND MCP: HTTP Error calling profile API: {str(e)}")
-            return [
-                TextContent(
-                    type="text",
-                    text=f'{{"error": "HTTP error: {str(e)}"}}',
-                )
-            ]
-        except Exception as e:
-            logger.error(f"❌ BACKEND MCP: Unexpected error: {str(e)}")
-            return [
-                TextContent(
-                    type="text",
-                    text=f'{{"error": "Unexpected error: {str(e)}"}}',
-                )
-            ]
-    
-    logger.error(f"❌ BACKEND MCP: Unknown tool: {name}")
+    if not usernames or not isinstance(usernames, list):
+        logger.error("check_entitlements missing_usernames")
+        return _ERR_NO_USERNAMES
+    
+    # Result keys are the usernames themselves, so every item must be a string
+    if not all(isinstance(username, str) for username in usernames):
+        logger.error("check_entitlements invalid_usernames")
+        return _ERR_INVALID_USERNAMES
+    
+    # Drop duplicates so each username is fetched and reported once
+    usernames = list(dict.fromkeys(usernames))
+    if len(usernames) > MAX_BATCH_SIZE:
+        logger.error("check_entitlements too_many_usernames count=%d", len(usernames))
+        return _ERR_TOO_MANY_USERNAMES
+    logger.info("check_entitlements count=%d", len(usernames))
+    
+    bodies = await asyncio.gather(*(_lookup(username) for username in usernames))
+    
+    # Bodies are already JSON, so splice them in rather than re-encoding
+    results = ", ".join(
+        f"{json_dumps(username)}: {body}"
+        for username, body in zip(usernames, bodies)
+    )
     return [
         TextContent(
             type="text",
-            text=f'{{"error": "Unknown tool: {name}"}}',
+            text=f'{{"results": {{{results}}}}}',
         )
     ]
 
 
+# Tool name -> handler
+_HANDLERS = {
+    "check_user_entitlement": _check_user_entitlement,
+    "check_user_entitlements": _check_user_entitlements,
+}
+
+
+@app.call_tool()
+async def call_tool(name: str, arguments: Any) -> list[TextContent]:
+    """Handle tool calls."""
+    handler = _HANDLERS.get(name)
+    if handler is not None:
+        return await handler(arguments)
+    
+    logger.error("unknown_tool name=%s", name)
+    return _err(f"Unknown tool: {name}")
+
+
+def _buffered_stdin() -> anyio.AsyncFile[str]:
+    """Wrap stdin with a larger buffer so big request frames need fewer reads."""
+    stdin = open(sys.stdin.fileno(), "rb", buffering=STDIO_BUFFER_SIZE, closefd=False)
+    # Match the SDK's own wrapper: a bad byte must not take the server down
+    return anyio.wrap_file(TextIOWrapper(stdin, encoding="utf-8", errors="replace"))
+
+
 async def main():
     """Run the MCP server."""
-    logger.info("🚀 Starting Entitlement MCP Server...")
-    async with stdio_server() as (read_stream, write_stream):
-        await app.run(
-            read_stream,
-            write_stream,
-            app.create_initialization_options(),
-        )
+    logger.info("server_start name=entitlement-server")
+    try:
+        async with stdio_server(_buffered_stdin()) as (read_stream, write_stream):
+            await app.run(
+                read_stream,
+                write_stream,
+                app.create_initialization_options(),
+            )
+    finally:
+        await _client.aclose()
+        if _redis is not None:
+            # Let pending writes finish before closing the connection pool
+            await asyncio.gather(*_redis_writes)
+            await _redis.aclose()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Use the libuv-based event loop when uvloop>=0.18 (uvloop.run) is installed
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+    if uvloop is not None and hasattr(uvloop, "run"):
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
 
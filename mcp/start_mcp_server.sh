@@ -43,7 +43,7 @@ echo ""
 # Check and install dependencies
 echo "📦 Checking dependencies..."
 
-python -c "import httpx" 2>/dev/null
+python -c "import httpx, h2" 2>/dev/null
 HTTPX_INSTALLED=$?
 
 python -c "import mcp" 2>/dev/null
@@ -51,7 +51,7 @@ MCP_INSTALLED=$?
 
 if [ $HTTPX_INSTALLED -ne 0 ] || [ $MCP_INSTALLED -ne 0 ]; then
     echo "📥 Installing dependencies..."
-    pip install httpx>=0.27.0 mcp>=1.0.0
+    pip install "httpx[http2]>=0.27.0" "mcp>=1.0.0"
     
     if [ $? -eq 0 ]; then
         echo "✅ Dependencies installed successfully"
@@ -63,13 +63,20 @@ else
     echo "✅ All dependencies already installed"
 fi
 
+# Development mode: skip TLS verification unless explicitly configured
+export PROFILE_SSL_VERIFY="${PROFILE_SSL_VERIFY:-0}"
+
 echo ""
 echo "═══════════════════════════════════════════════════════════════"
 echo "  📋 Configuration"
 echo "═══════════════════════════════════════════════════════════════"
 echo ""
 echo "  Profile API: https://localhost:8080/services/security/profile"
-echo "  SSL Verification: Disabled (Development Mode)"
+if [ "$PROFILE_SSL_VERIFY" = "0" ]; then
+    echo "  SSL Verification: Disabled (Development Mode)"
+else
+    echo "  SSL Verification: Enabled"
+fi
 echo "  Virtual Environment: $(pwd)/$VENV_DIR"
 echo ""
 echo "═══════════════════════════════════════════════════════════════"
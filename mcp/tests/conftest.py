@@ -0,0 +1,12 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# entitlement_mcp.py is run as a script, so make it importable from the tests
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
@@ -0,0 +1,378 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import anyio
+import httpx
+import pytest
+from mcp.server.stdio import stdio_server
+
+import entitlement_mcp
+
+pytestmark = pytest.mark.anyio
+
+
+def _profile(username: str) -> dict:
+    return {"data": {"profile": {"username": username}}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(
+        entitlement_mcp, "time", SimpleNamespace(monotonic=lambda: now.value)
+    )
+    return now
+
+
+@pytest.fixture
+async def profile_api(monkeypatch):
+    """Route profile API calls to a swappable handler and record each username."""
+    api = SimpleNamespace(calls=[], handler=None)
+
+    async def dispatch(request: httpx.Request) -> httpx.Response:
+        prefix = entitlement_mcp._UUNAME_PREFIX
+        username = request.content[len(prefix):].decode("ascii")
+        api.calls.append(username)
+        if api.handler is not None:
+            return await api.handler(username)
+        return httpx.Response(200, json=_profile(username))
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(dispatch))
+    monkeypatch.setattr(entitlement_mcp, "_client", client)
+    monkeypatch.setattr(
+        entitlement_mcp,
+        "_build_profile_request",
+        lambda content: client.build_request(
+            "POST", entitlement_mcp.PROFILE_API_URL, content=content
+        ),
+    )
+    monkeypatch.setattr(entitlement_mcp, "_redis", None)
+    entitlement_mcp._profile_cache.clear()
+    entitlement_mcp._stale_cache.clear()
+    entitlement_mcp._inflight.clear()
+    yield api
+    await client.aclose()
+
+
+class FakeRedis:
+    """In-memory stand-in for the redis.asyncio calls the server makes."""
+
+    def __init__(self):
+        # key -> (value, remaining milliseconds, or -1 for no expiry)
+        self.store = {}
+        self.sets = []
+        self.error = None
+        self.closed = False
+        # Set to an unset Event to hold writes until the test releases them
+        self.write_gate = None
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def set(self, key, value, px):
+        if self.write_gate is not None:
+            await self.write_gate.wait()
+        if self.error is not None:
+            raise self.error
+        self.sets.append((key, value, px))
+        self.store[key] = (value.encode("utf-8"), px)
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    def get(self, key):
+        self.commands.append(lambda: self.redis.store.get(key, (None, -2))[0])
+        return self
+
+    def pttl(self, key):
+        self.commands.append(lambda: self.redis.store.get(key, (None, -2))[1])
+        return self
+
+    async def execute(self):
+        if self.redis.error is not None:
+            raise self.redis.error
+        return [command() for command in self.commands]
+
+
+@pytest.fixture
+def fake_redis(profile_api, monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(entitlement_mcp, "_redis", redis)
+    return redis
+
+
+def _redis_key(username: str) -> str:
+    return entitlement_mcp._REDIS_KEY_PREFIX + username
+
+
+async def test_cache_hit_then_expiry(profile_api, clock) -> None:
+    first = await entitlement_mcp._lookup("pe06003")
+    second = await entitlement_mcp._lookup("pe06003")
+
+    assert first == second
+    assert json.loads(first) == _profile("pe06003")
+    assert profile_api.calls == ["pe06003"]
+
+    clock.value += entitlement_mcp.PROFILE_CACHE_TTL + 1
+    await entitlement_mcp._lookup("pe06003")
+
+    assert profile_api.calls == ["pe06003", "pe06003"]
+
+
+async def test_concurrent_misses_share_one_request(profile_api) -> None:
+    release = asyncio.Event()
+
+    async def slow(username: str) -> httpx.Response:
+        await release.wait()
+        return httpx.Response(200, json=_profile(username))
+
+    profile_api.handler = slow
+    waiters = [
+        asyncio.ensure_future(entitlement_mcp._lookup("pe06003")) for _ in range(5)
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    bodies = await asyncio.gather(*waiters)
+
+    assert len(set(bodies)) == 1
+    assert profile_api.calls == ["pe06003"]
+
+
+async def test_cancelled_waiter_does_not_abort_shared_fetch(profile_api) -> None:
+    release = asyncio.Event()
+
+    async def slow(username: str) -> httpx.Response:
+        await release.wait()
+        return httpx.Response(200, json=_profile(username))
+
+    profile_api.handler = slow
+    cancelled = asyncio.ensure_future(entitlement_mcp._lookup("pe06003"))
+    survivor = asyncio.ensure_future(entitlement_mcp._lookup("pe06003"))
+    await asyncio.sleep(0)
+
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    release.set()
+
+    assert json.loads(await survivor) == _profile("pe06003")
+    assert cancelled.cancelled()
+    assert profile_api.calls == ["pe06003"]
+
+
+async def test_stale_profile_served_on_http_error(
+    profile_api, clock, monkeypatch
+) -> None:
+    monkeypatch.setattr(entitlement_mcp, "STALE_FALLBACK_ENABLED", True)
+    good = await entitlement_mcp._lookup("pe06003")
+
+    async def failing(username: str) -> httpx.Response:
+        return httpx.Response(503)
+
+    profile_api.handler = failing
+    clock.value += entitlement_mcp.PROFILE_CACHE_TTL + 1
+
+    assert await entitlement_mcp._lookup("pe06003") == good
+    assert len(profile_api.calls) == 2
+
+
+async def test_http_error_without_stale_profile_is_json_error(profile_api) -> None:
+    async def failing(username: str) -> httpx.Response:
+        return httpx.Response(503)
+
+    profile_api.handler = failing
+
+    body = json.loads(await entitlement_mcp._lookup("pe06003"))
+
+    assert body["error"].startswith("HTTP error:")
+
+
+async def test_batch_reply_is_always_valid_json(profile_api) -> None:
+    async def mixed(username: str) -> httpx.Response:
+        if username == "html":
+            return httpx.Response(
+                200, text="<html>\n</html>", headers={"content-type": "text/html"}
+            )
+        if username == "broken":
+            return httpx.Response(
+                200, text='{"data": ', headers={"content-type": "application/json"}
+            )
+        if username == "down":
+            return httpx.Response(500, text="oops\n\"quoted\"")
+        return httpx.Response(200, json=_profile(username))
+
+    profile_api.handler = mixed
+    usernames = ["pe06003", "html", "broken", "down", "bad name", "pe06003"]
+
+    [reply] = await entitlement_mcp._check_user_entitlements({"usernames": usernames})
+    results = json.loads(reply.text)["results"]
+
+    assert list(results) == ["pe06003", "html", "broken", "down", "bad name"]
+    assert results["pe06003"] == _profile("pe06003")
+    for username in ("html", "broken", "down", "bad name"):
+        assert "error" in results[username]
+    # Invalid bodies must never be cached
+    assert set(entitlement_mcp._profile_cache) == {"pe06003"}
+
+
+@pytest.mark.parametrize("usernames", [[None, 123], [], "pe06003"])
+async def test_batch_rejects_bad_username_lists(profile_api, usernames) -> None:
+    [reply] = await entitlement_mcp._check_user_entitlements({"usernames": usernames})
+
+    assert "error" in json.loads(reply.text)
+    assert profile_api.calls == []
+
+
+async def test_batch_rejects_oversized_batches(profile_api) -> None:
+    usernames = [f"user{i}" for i in range(entitlement_mcp.MAX_BATCH_SIZE + 1)]
+
+    [reply] = await entitlement_mcp._check_user_entitlements({"usernames": usernames})
+
+    assert "error" in json.loads(reply.text)
+    assert profile_api.calls == []
+
+
+async def test_stdin_survives_invalid_utf8(monkeypatch) -> None:
+    read_fd, write_fd = os.pipe()
+    initialize = {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": "initialize",
+        "params": {
+            "protocolVersion": "2024-11-05",
+            "capabilities": {},
+            "clientInfo": {"name": "test", "version": "0"},
+        },
+    }
+    os.write(write_fd, b"\xff\xfe garbage\n" + json.dumps(initialize).encode() + b"\n")
+    os.close(write_fd)
+    monkeypatch.setattr(sys, "stdin", SimpleNamespace(fileno=lambda: read_fd))
+
+    try:
+        stdin = entitlement_mcp._buffered_stdin()
+        stdout = anyio.wrap_file(io.StringIO())
+        async with stdio_server(stdin, stdout) as (read_stream, write_stream):
+            # Nothing is sent back, so let the writer finish once input runs out
+            await write_stream.aclose()
+            bad, good = [message async for message in read_stream]
+    finally:
+        os.close(read_fd)
+
+    assert isinstance(bad, Exception)
+    assert good.message.root.method == "initialize"
+
+
+async def test_redis_hit_fills_memory_cache_with_remaining_ttl(
+    profile_api, fake_redis, clock
+) -> None:
+    body = json.dumps(_profile("pe06003"))
+    fake_redis.store[_redis_key("pe06003")] = (body.encode(), 5000)
+
+    assert await entitlement_mcp._lookup("pe06003") == body
+    assert entitlement_mcp._profile_cache["pe06003"] == (clock.value + 5.0, body)
+    assert profile_api.calls == []
+
+    # Expires locally with the shared entry, not a full TTL later
+    clock.value += 5.0
+
+    assert entitlement_mcp._cache_get("pe06003") is None
+
+
+async def test_redis_key_without_expiry_uses_full_ttl(
+    profile_api, fake_redis, clock
+) -> None:
+    body = json.dumps(_profile("pe06003"))
+    fake_redis.store[_redis_key("pe06003")] = (body.encode(), -1)
+
+    await entitlement_mcp._lookup("pe06003")
+
+    expires_at, _ = entitlement_mcp._profile_cache["pe06003"]
+    assert expires_at == clock.value + entitlement_mcp.PROFILE_CACHE_TTL
+
+
+async def test_redis_key_expired_between_commands_is_a_miss(
+    profile_api, fake_redis
+) -> None:
+    fake_redis.store[_redis_key("pe06003")] = (b'{"stale": true}', -2)
+
+    body = await entitlement_mcp._lookup("pe06003")
+
+    assert json.loads(body) == _profile("pe06003")
+    assert profile_api.calls == ["pe06003"]
+
+
+async def test_redis_miss_writes_in_background(profile_api, fake_redis) -> None:
+    fake_redis.write_gate = asyncio.Event()
+
+    body = await entitlement_mcp._lookup("pe06003")
+
+    # The reply does not wait for the write
+    assert fake_redis.sets == []
+    assert len(entitlement_mcp._redis_writes) == 1
+
+    fake_redis.write_gate.set()
+    await asyncio.gather(*entitlement_mcp._redis_writes)
+
+    ttl_ms = int(entitlement_mcp.PROFILE_CACHE_TTL * 1000)
+    assert fake_redis.sets == [(_redis_key("pe06003"), body, ttl_ms)]
+    assert not entitlement_mcp._redis_writes
+
+
+async def test_redis_write_skipped_without_positive_ttl(
+    profile_api, fake_redis, monkeypatch
+) -> None:
+    monkeypatch.setattr(entitlement_mcp, "PROFILE_CACHE_TTL", 0.0)
+
+    await entitlement_mcp._redis_set("pe06003", "{}")
+
+    assert fake_redis.sets == []
+
+
+async def test_redis_errors_fall_back_to_profile_api(profile_api, fake_redis) -> None:
+    fake_redis.error = ConnectionError("redis down")
+
+    body = await entitlement_mcp._lookup("pe06003")
+    await asyncio.gather(*entitlement_mcp._redis_writes)
+
+    assert json.loads(body) == _profile("pe06003")
+    assert profile_api.calls == ["pe06003"]
+    assert fake_redis.sets == []
+
+
+async def test_main_drains_redis_writes_before_closing(
+    profile_api, fake_redis, monkeypatch
+) -> None:
+    @contextlib.asynccontextmanager
+    async def no_stdio(stdin):
+        yield None, None
+
+    async def run(read_stream, write_stream, options):
+        fake_redis.write_gate = asyncio.Event()
+        entitlement_mcp._redis_set_later("pe06003", "{}")
+        asyncio.get_running_loop().call_later(0.01, fake_redis.write_gate.set)
+
+    monkeypatch.setattr(entitlement_mcp, "_buffered_stdin", lambda: None)
+    monkeypatch.setattr(entitlement_mcp, "stdio_server", no_stdio)
+    monkeypatch.setattr(entitlement_mcp.app, "run", run)
+
+    await entitlement_mcp.main()
+
+    ttl_ms = int(entitlement_mcp.PROFILE_CACHE_TTL * 1000)
+    assert fake_redis.sets == [(_redis_key("pe06003"), "{}", ttl_ms)]
+    assert fake_redis.closed